@@ -2,12 +2,28 @@
 
 __version__ = "0.2.1"
 
-from .patches.patcher import apply_patch, is_patched
-from .patches.low_memory import enable_low_memory_mode, disable_low_memory_mode, is_low_memory_enabled
-from .scripts.fix_model import fix_nvfp4_model
+import importlib
+
+from .patches.patcher import apply_patch, apply_runtime_patch, is_patched
+
+# These pull in torch, compressed_tensors and transformers, so they are only
+# imported on first use to keep `nvfp4-fix check` fast
+_LAZY_IMPORTS = {
+    "enable_low_memory_mode": ".patches.low_memory",
+    "disable_low_memory_mode": ".patches.low_memory",
+    "is_low_memory_enabled": ".patches.low_memory",
+    "fix_nvfp4_model": ".scripts.fix_model",
+}
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        module = importlib.import_module(_LAZY_IMPORTS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 __all__ = [
     "apply_patch", 
+    "apply_runtime_patch",
     "is_patched", 
     "enable_low_memory_mode",
     "disable_low_memory_mode",
@@ -3,7 +3,6 @@
 import argparse
 import sys
 from .patches.patcher import apply_patch, is_patched
-from .patches.low_memory import enable_low_memory_mode, is_low_memory_enabled
 
 def main():
     parser = argparse.ArgumentParser(
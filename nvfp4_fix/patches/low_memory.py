@@ -6,7 +6,59 @@ from compressed_tensors.linear.compressed_linear import CompressedLinear, Quanti
 _original_forward = None
 _patched = False
 
-def enable_low_memory_mode():
+# Strategies whose scales are per output channel (or a single global value),
+# so a row slice of the weight pairs with a row slice of the scales
+BLOCKWISE_STRATEGIES = {"tensor_group", "group", "channel", "tensor"}
+
+def supports_block_decompression(module):
+    """Check if a module's weight can be decompressed in output-channel blocks."""
+    scheme = getattr(module, "quantization_scheme", None)
+    if scheme is None or scheme.weights is None:
+        return False
+    if not hasattr(module.compressor, "decompress_weight"):
+        return False
+    # Compressors that record the full weight_shape can't decode a row slice
+    if "weight_shape" in module._parameters:
+        return False
+    
+    strategy = getattr(scheme.weights.strategy, "value", scheme.weights.strategy)
+    if strategy not in BLOCKWISE_STRATEGIES:
+        return False
+    if strategy != "tensor":
+        scale = getattr(module, "weight_scale", None)
+        if scale is None or scale.dim() == 0 or scale.shape[0] != module.out_features:
+            return False
+    return True
+
+def blockwise_linear(module, input, block_size):
+    """
+    Run the linear layer one block of output channels at a time.
+    
+    Only one block_size x in_features slice of the decompressed weight
+    exists at any moment, instead of the full BF16 weight.
+    """
+    out_features = module.out_features
+    compressed_data = dict(module.named_parameters(recurse=False))
+    compressed_data.update(module.named_buffers(recurse=False))
+    quantization_args = module.quantization_scheme.weights
+    
+    outputs = []
+    for lo in range(0, out_features, block_size):
+        hi = min(lo + block_size, out_features)
+        # Per-output-channel tensors are sliced, global scales are shared
+        block_data = {
+            name: tensor[lo:hi] if tensor.dim() > 0 and tensor.shape[0] == out_features else tensor
+            for name, tensor in compressed_data.items()
+        }
+        weight_block = module.compressor.decompress_weight(
+            compressed_data=block_data, quantization_args=quantization_args
+        )
+        bias = None if module.bias is None else module.bias[lo:hi]
+        outputs.append(torch.nn.functional.linear(input, weight_block, bias))
+        del weight_block
+    return torch.cat(outputs, dim=-1)
+
+def enable_low_memory_mode(cache_after_n_calls=None, block_size=None):
     """
     Enable low-memory mode for NVFP4 models.
     
@@ -14,9 +66,25 @@ def enable_low_memory_mode():
     at the cost of slightly slower inference (decompresses each forward pass).
     
     Essential for running 15B+ NVFP4 models on 16GB GPUs.
+    
+    Args:
+        cache_after_n_calls: Keep a layer's decompressed weight once it has
+            been decompressed this many times. Layers that stay hot stop
+            paying the dequant cost, at the price of their BF16 footprint.
+            None (default) never caches.
+        block_size: Decompress and multiply this many output channels at a
+            time, so the full BF16 weight is never materialized. Only layers
+            with per-channel, per-group or per-tensor scales are split; the
+            rest (e.g. block-quantized FP8) fall back to full decompression.
+            None (default) always decompresses the whole weight.
     """
     global _original_forward, _patched
     
+    if cache_after_n_calls is not None and cache_after_n_calls < 1:
+        raise ValueError(f"cache_after_n_calls must be at least 1, got {cache_after_n_calls}")
+    if block_size is not None and block_size <= 0:
+        raise ValueError(f"block_size must be a positive integer, got {block_size}")
+    
     if _patched:
         print("Low-memory mode already enabled")
         return
@@ -26,6 +94,22 @@ def enable_low_memory_mode():
     def compressed_forward(self, input):
         """Modified forward that decompresses on-the-fly without caching"""
         if self.quantization_status == QuantizationStatus.COMPRESSED:
+            cached_weight = self.__dict__.get("_cached_weight")
+            if cached_weight is not None:
+                return torch.nn.functional.linear(input, cached_weight, self.bias)
+            
+            if cache_after_n_calls is not None:
+                # object.__setattr__ keeps these out of nn.Module's registries
+                fwd_count = self.__dict__.get("_fwd_count", 0) + 1
+                object.__setattr__(self, "_fwd_count", fwd_count)
+                if fwd_count >= cache_after_n_calls:
+                    weight_data = self.compressor.decompress_module(self)
+                    object.__setattr__(self, "_cached_weight", weight_data)
+                    return torch.nn.functional.linear(input, weight_data, self.bias)
+            
+            if block_size is not None and supports_block_decompression(self):
+                return blockwise_linear(self, input, block_size)
+            
             # Decompress temporarily without caching
             weight_data = self.compressor.decompress_module(self)
             output = torch.nn.functional.linear(input, weight_data, self.bias)
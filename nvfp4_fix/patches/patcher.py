@@ -1,51 +1,194 @@
 """Patch compressed-tensors to support NVFP4 weight_scale buffers."""
 
+import ast
+import importlib.util
+import json
+import mmap
+import os
+import re
 import sys
 import shutil
 from pathlib import Path
 
+# Written into the compressed_tensors package once all three patches are verified.
+# Holds each file's (inode, size, mtime) so any replacement invalidates it.
+PATCH_MARKER = ".nvfp4_patched_v2"
+
+# Comments left by each patch, used to detect already-applied patches
+BUFFER_PATCH = "# PATCH: Also add named_buffers"
+SKIP_SCALE_PATCH = "# PATCHED: Don't skip scale for NVFP4"
+FLOAT8_PATCH = "# PATCHED: Convert float8 to avoid promotion errors"
+
+BUFFER_LOOP_PATTERN = re.compile(
+    r'(^([ \t]+)for name, parameter in module\.named_parameters\(\):\n'
+    r'[ \t]+compressed_data\[[^\n]+\n)',
+    re.M,
+)
+
 def find_compressed_tensors_files():
     """Find the compressed_tensors files that need patching."""
-    try:
-        import compressed_tensors
-        package_path = Path(compressed_tensors.__file__).parent
-        base_file = package_path / "compressors" / "base.py"
-        quantized_base = package_path / "compressors" / "quantized_compressors" / "base.py"
-        fp4_file = package_path / "compressors" / "quantized_compressors" / "fp4_quantized.py"
-        return base_file, quantized_base, fp4_file
-    except ImportError:
+    # Locate the package without importing it (and pulling in torch)
+    spec = importlib.util.find_spec("compressed_tensors")
+    if spec is None or spec.origin is None:
         raise ImportError(
             "compressed-tensors not installed. "
             "Install with: pip install compressed-tensors"
         )
+    package_path = Path(spec.origin).parent
+    base_file = package_path / "compressors" / "base.py"
+    quantized_base = package_path / "compressors" / "quantized_compressors" / "base.py"
+    fp4_file = package_path / "compressors" / "quantized_compressors" / "fp4_quantized.py"
+    return base_file, quantized_base, fp4_file
+
+def insert_module_import(content, statement):
+    """Insert an import line after the module docstring and __future__ imports."""
+    insert_at = 0
+    for index, node in enumerate(ast.parse(content).body):
+        is_docstring = (
+            index == 0
+            and isinstance(node, ast.Expr)
+            and isinstance(node.value, ast.Constant)
+            and isinstance(node.value.value, str)
+        )
+        is_future = isinstance(node, ast.ImportFrom) and node.module == "__future__"
+        if not (is_docstring or is_future):
+            break
+        insert_at = node.end_lineno
+    
+    lines = content.splitlines(keepends=True)
+    if insert_at and not lines[insert_at - 1].endswith('\n'):
+        lines[insert_at - 1] += '\n'
+    lines.insert(insert_at, statement + '\n')
+    return ''.join(lines)
+
+def get_marker_path(base_file):
+    """Return the patch marker path inside the compressed_tensors package."""
+    return Path(base_file).parents[1] / PATCH_MARKER
+
+def file_signatures(files):
+    """Identify the current version of each file by inode, size and mtime."""
+    signatures = []
+    for path in files:
+        st = os.stat(path)
+        signatures.append([st.st_ino, st.st_size, st.st_mtime_ns])
+    return signatures
+
+def marker_is_current(files):
+    """Check that none of the files was replaced or modified since the marker was written."""
+    try:
+        with open(get_marker_path(files[0]), 'r') as f:
+            return json.load(f) == file_signatures(files)
+    except (OSError, ValueError):
+        return False
+
+def write_patch_marker(files):
+    """Record a verified patch. Skipped if the package directory is read-only."""
+    try:
+        with open(get_marker_path(files[0]), 'w') as f:
+            json.dump(file_signatures(files), f)
+    except OSError:
+        pass
+
+def file_contains(path, needle):
+    """Search a file for a substring without reading it into Python."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.find(needle.encode()) != -1
+
+def contains_patches(base_file, quantized_base, fp4_file):
+    """Scan the three files for their patch comments, stopping at the first miss."""
+    return (
+        file_contains(base_file, BUFFER_PATCH)
+        and file_contains(quantized_base, SKIP_SCALE_PATCH)
+        and file_contains(fp4_file, FLOAT8_PATCH)
+    )
 
 def is_patched():
     """Check if compressed-tensors is already patched."""
     try:
-        base_file, quantized_base, fp4_file = find_compressed_tensors_files()
-        
-        # Check base.py for buffer patch
-        with open(base_file, 'r') as f:
-            base_patched = "# PATCH: Also add named_buffers" in f.read()
-        
-        # Check quantized base.py for skip_scale patch
-        with open(quantized_base, 'r') as f:
-            content = f.read()
-            skip_patched = "# PATCHED: Don't skip scale for NVFP4" in content
-        
-        # Check fp4_quantized.py for float8 conversion patch
-        with open(fp4_file, 'r') as f:
-            content = f.read()
-            fp4_patched = "# PATCHED: Convert float8 to avoid promotion errors" in content
-        
-        return base_patched and skip_patched and fp4_patched
+        files = find_compressed_tensors_files()
+        # Fast path: a few stat calls if nothing changed since the last patch
+        return marker_is_current(files) or contains_patches(*files)
     except Exception:
         return False
 
+def apply_runtime_patch():
+    """
+    Stop compressed-tensors from skipping weight_scale in this process only.
+    
+    Overrides _skip_scale on the imported classes without touching any file,
+    so it keeps working after compressed-tensors is upgraded. Patches 1 and 3
+    are still needed on disk.
+    
+    Returns:
+        bool: True if a _skip_scale method was found and overridden
+    """
+    from compressed_tensors.compressors.quantized_compressors import base
+    
+    patched = False
+    for obj in list(vars(base).values()):
+        if isinstance(obj, type) and '_skip_scale' in vars(obj):
+            obj._skip_scale = lambda self: False
+            patched = True
+    return patched
+
+def patch_base(content):
+    """Patch 1: include buffers (e.g. weight_scale) in decompression."""
+    # Insert the buffer loop right after the parameter loop that fills compressed_data
+    content, count = BUFFER_LOOP_PATTERN.subn(
+        lambda m: (
+            m.group(1)
+            + m.group(2) + BUFFER_PATCH + ' (e.g., weight_scale)\n'
+            + m.group(2) + 'for name, buffer in module.named_buffers():\n'
+            + m.group(2) + '    compressed_data[name] = buffer\n'
+        ),
+        content,
+        count=1,
+    )
+    return content if count == 1 else None
+
+def patch_quantized_base(content):
+    """Patch 2: don't skip weight_scale loading."""
+    # Override _skip_scale on each class at the end of the module rather than
+    # rewriting the method body, so decorators or reformatting don't matter
+    class_names = [
+        node.name for node in ast.parse(content).body
+        if isinstance(node, ast.ClassDef) and any(
+            isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)) and item.name == '_skip_scale'
+            for item in node.body
+        )
+    ]
+    if not class_names:
+        return None
+    
+    overrides = ''.join(f'{name}._skip_scale = lambda self: False\n' for name in class_names)
+    return content.rstrip('\n') + '\n\n\n' + SKIP_SCALE_PATCH + ' - we need it!\n' + overrides
+
+def patch_fp4(content):
+    """Patch 3: convert float8 scales to bfloat16 before decompression."""
+    # Find and replace the scale loading line
+    old_code = '        scale = compressed_data["weight_scale"]'
+    
+    new_code = f'''        scale = compressed_data["weight_scale"]
+        {FLOAT8_PATCH}
+        if scale.dtype == torch.float8_e4m3fn:
+            scale = scale.to(torch.bfloat16)'''
+    
+    if old_code not in content:
+        return None
+    content = content.replace(old_code, new_code)
+    
+    # The patched code runs on every decompression, so import torch at module scope
+    if not re.search(r'^import torch$', content, re.M):
+        content = insert_module_import(content, 'import torch')
+    return content
+
 def apply_patch(verbose=True):
     """Apply the NVFP4 buffer patch to compressed-tensors."""
     
-    base_file, quantized_base, fp4_file = find_compressed_tensors_files()
+    base_file, quantized_base, fp4_file = files = find_compressed_tensors_files()
     
     if verbose:
         print(f"Found compressed-tensors at:")
@@ -54,121 +197,73 @@ def apply_patch(verbose=True):
         print(f"  {fp4_file}")
     
     if is_patched():
+        # Only reached without a current marker after a full content scan
+        if not marker_is_current(files):
+            write_patch_marker(files)
         if verbose:
             print("✓ Already patched!")
         return True
     
-    # Patch 1: base.py - Add buffers to decompression
-    if verbose:
-        print("\nApplying Patch 1: Include buffers in decompression...")
-    
-    backup_path = str(base_file) + ".backup"
-    shutil.copy(base_file, backup_path)
-    
-    with open(base_file, 'r') as f:
-        lines = f.readlines()
+    patches = [
+        ("Patch 1: Include buffers in decompression", base_file, BUFFER_PATCH, patch_base),
+        ("Patch 2: Force loading of weight_scale", quantized_base, SKIP_SCALE_PATCH, patch_quantized_base),
+        ("Patch 3: Handle Float8 dtype conversion", fp4_file, FLOAT8_PATCH, patch_fp4),
+    ]
     
-    new_lines = []
-    patched = False
+    # Build and validate every patched file before writing any of them, so a
+    # failure never leaves a half-patched install behind
+    new_contents = {}
+    for description, path, marker, build in patches:
+        if verbose:
+            print(f"\nPreparing {description}...")
+        with open(path, 'r') as f:
+            content = f.read()
+        
+        if marker in content:
+            if verbose:
+                print(f"✓ Already applied: {path}")
+            continue
+        
+        new_content = build(content)
+        try:
+            if new_content is not None:
+                compile(new_content, str(path), 'exec')
+        except SyntaxError:
+            new_content = None
+        if new_content is None:
+            if verbose:
+                print(f"❌ Failed to patch {path}")
+            return False
+        new_contents[path] = new_content
     
-    for i, line in enumerate(lines):
-        new_lines.append(line)
+    backups = []
+    for path, content in new_contents.items():
+        # Never overwrite an existing backup: it is the only pristine copy
+        backup_path = str(path) + ".backup"
+        if not os.path.exists(backup_path):
+            shutil.copy(path, backup_path)
+        backups.append(backup_path)
         
-        if 'for name, parameter in module.named_parameters():' in line and i > 180 and not patched:
-            indent = line[:len(line) - len(line.lstrip())]
-            i += 1
-            new_lines.append(lines[i])
-            
-            new_lines.append(indent + '# PATCH: Also add named_buffers (e.g., weight_scale)\n')
-            new_lines.append(indent + 'for name, buffer in module.named_buffers():\n')
-            new_lines.append(indent + '    compressed_data[name] = buffer\n')
-            
-            for j in range(i+1, len(lines)):
-                new_lines.append(lines[j])
-            patched = True
-            break
+        with open(path, 'w') as f:
+            f.write(content)
+        
+        if verbose:
+            print(f"✓ Patched: {path}")
     
-    if not patched:
+    if not contains_patches(*files):
         if verbose:
-            print("❌ Failed to patch base.py")
+            print("❌ Patched files are missing their patch markers")
         return False
+    write_patch_marker(files)
     
-    with open(base_file, 'w') as f:
-        f.writelines(new_lines)
-    
-    if verbose:
-        print(f"✓ Patched: {base_file}")
-    
-    # Patch 2: quantized_compressors/base.py - Don't skip weight_scale loading
-    if verbose:
-        print("\nApplying Patch 2: Force loading of weight_scale...")
-    
-    backup_path2 = str(quantized_base) + ".backup"
-    shutil.copy(quantized_base, backup_path2)
-    
-    with open(quantized_base, 'r') as f:
-        lines = f.readlines()
-    
-    # Find and replace the _skip_scale method (around line 137-140)
-    new_lines = []
-    i = 0
-    while i < len(lines):
-        if 'def _skip_scale(self):' in lines[i]:
-            # Replace the entire method
-            indent = lines[i][:len(lines[i]) - len(lines[i].lstrip())]
-            new_lines.append(indent + 'def _skip_scale(self):\n')
-            new_lines.append(indent + '    # PATCHED: Don\'t skip scale for NVFP4 - we need it!\n')
-            new_lines.append(indent + '    return False\n')
-            
-            # Skip original method lines until next method
-            i += 1
-            while i < len(lines) and not (lines[i].strip().startswith('def ') and lines[i][0] != ' '):
-                if 'def ' in lines[i] and lines[i][:4] == '    ':  # Next method at same level
-                    break
-                i += 1
-            continue
-        else:
-            new_lines.append(lines[i])
-            i += 1
+    # The file patch only takes effect on the next import
+    if "compressed_tensors.compressors.quantized_compressors.base" in sys.modules:
+        apply_runtime_patch()
     
-    with open(quantized_base, 'w') as f:
-        f.writelines(new_lines)
-    
-    if verbose:
-        print(f"✓ Patched: {quantized_base}")
-    
-    # Patch 3: fp4_quantized.py - Convert Float8 to BFloat16
-    if verbose:
-        print("\nApplying Patch 3: Handle Float8 dtype conversion...")
-    
-    backup_path3 = str(fp4_file) + ".backup"
-    shutil.copy(fp4_file, backup_path3)
-    
-    with open(fp4_file, 'r') as f:
-        content = f.read()
-    
-    # Find and replace the scale loading line
-    old_code = '        scale = compressed_data["weight_scale"]'
-    
-    new_code = '''        scale = compressed_data["weight_scale"]
-        # PATCHED: Convert float8 to avoid promotion errors
-        import torch
-        if scale.dtype == torch.float8_e4m3fn:
-            scale = scale.to(torch.bfloat16)'''
-    
-    content = content.replace(old_code, new_code)
-    
-    with open(fp4_file, 'w') as f:
-        f.write(content)
-    
-    if verbose:
-        print(f"✓ Patched: {fp4_file}")
-    
-    if verbose:
-        print(f"\n📦 Backups created:")
-        print(f"  {backup_path}")
-        print(f"  {backup_path2}")
-        print(f"  {backup_path3}")
+    if verbose and backups:
+        print(f"\n📦 Backups:")
+        for backup_path in backups:
+            print(f"  {backup_path}")
     
     return True
 
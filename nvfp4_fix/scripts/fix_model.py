@@ -1,10 +1,14 @@
 """Fix NVFP4 quantized models by injecting missing weight_scale buffers."""
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from safetensors import safe_open
-from transformers import AutoModelForCausalLM, AutoConfig
+from transformers import AutoModelForCausalLM, AutoConfig, CompressedTensorsConfig
 import torch
 import glob
+import os
+import re
+import shutil
 
 def get_model_class(model_path):
     """Determine the appropriate model class."""
@@ -17,7 +21,94 @@ def get_model_class(model_path):
     
     return AutoModelForCausalLM
 
-def fix_nvfp4_model(input_path, output_path, dtype="bfloat16", verbose=True):
+def cast_float8_scales(scales, torch_dtype):
+    """Cast all float8 scales to torch_dtype in place with a single conversion."""
+    fp8_keys = [key for key, scale in scales.items() if scale.dtype == torch.float8_e4m3fn]
+    if not fp8_keys:
+        return scales
+    
+    # Scales differ in shape, so flatten, concatenate, cast once, then split back.
+    # Popping the originals lets them be freed as soon as they are concatenated.
+    shapes = [scales[key].shape for key in fp8_keys]
+    flat = torch.cat([scales.pop(key).reshape(-1) for key in fp8_keys])
+    flat = flat.to(torch_dtype)
+    
+    sizes = [shape.numel() for shape in shapes]
+    for key, shape, chunk in zip(fp8_keys, shapes, torch.split(flat, sizes)):
+        scales[key] = chunk.view(shape)
+    return scales
+
+LANGUAGE_MODEL_RENAME = ('language_model.model.layers', 'model.language_model.layers')
+
+def make_key_mapper(model):
+    """
+    Build a function mapping checkpoint tensor names to the model's names.
+    
+    Uses the model's _checkpoint_conversion_mapping (regex -> replacement),
+    applied the same way from_pretrained applies it: the first matching
+    pattern wins.
+    """
+    conversion_mapping = getattr(model, "_checkpoint_conversion_mapping", None) or {}
+    if not conversion_mapping:
+        def to_model_key(key):
+            if LANGUAGE_MODEL_RENAME[0] in key:
+                return key.replace(*LANGUAGE_MODEL_RENAME)
+            return key
+        return to_model_key
+    
+    patterns = [(re.compile(pattern), replacement) for pattern, replacement in conversion_mapping.items()]
+    
+    def to_model_key(key):
+        for pattern, replacement in patterns:
+            key, count = pattern.subn(replacement, key)
+            if count:
+                break
+        return key
+    return to_model_key
+
+def find_shard_scales(shard_path, to_model_key):
+    """Map module names to the weight_scale keys stored in one shard."""
+    with safe_open(shard_path, framework="pt", device="cpu") as f:
+        # Only the header is read here; tensors are fetched at injection time
+        return {
+            to_model_key(key)[:-len('.weight_scale')]: key
+            for key in f.keys() if key.endswith('.weight_scale')
+        }
+
+def load_shard_scales(shard_path, scale_keys, torch_dtype):
+    """
+    Load weight_scale tensors from one shard, keyed by module name.
+    
+    scale_keys maps module names to their key in the shard.
+    """
+    with safe_open(shard_path, framework="pt", device="cpu") as f:
+        shard_scales = {name: f.get_slice(key)[:] for name, key in scale_keys.items()}
+    
+    # Convert float8 to target dtype
+    return cast_float8_scales(shard_scales, torch_dtype)
+
+def side_file_filter(output_path):
+    """
+    Build a copytree ignore function that skips weights and the output dir.
+    
+    Weights in any format (and their index files) are skipped because
+    save_pretrained writes the fixed ones. If output_path lies inside the
+    input directory it is skipped too, so re-runs don't copy it into itself.
+    """
+    ignore_weights = shutil.ignore_patterns(
+        "*.safetensors*", "*.bin*", "*.pt*", "*.h5", "*.msgpack", "*.gguf",
+        "*.onnx", "*.ckpt", "original", ".git", ".cache",
+    )
+    output_path = Path(output_path).resolve()
+    
+    def ignore(directory, names):
+        ignored = set(ignore_weights(directory, names))
+        if Path(directory).resolve() == output_path.parent:
+            ignored.add(output_path.name)
+        return ignored
+    return ignore
+
+def fix_nvfp4_model(input_path, output_path, dtype="bfloat16", verbose=True, full_check=False):
     """
     Fix NVFP4 model and save corrected version.
     
@@ -26,6 +117,8 @@ def fix_nvfp4_model(input_path, output_path, dtype="bfloat16", verbose=True):
         output_path: Path to save the fixed model
         dtype: Target dtype ("bfloat16" or "float16")
         verbose: Print progress messages
+        full_check: Run a forward pass through the whole model instead of
+            a single patched layer
     
     Returns:
         bool: True if successful
@@ -45,10 +138,16 @@ def fix_nvfp4_model(input_path, output_path, dtype="bfloat16", verbose=True):
     if verbose:
         print("\n1. Loading model...")
     ModelClass = get_model_class(input_path)
+    # With a device_map, from_pretrained already builds the model on the meta
+    # device and materializes each tensor straight from the shards, applying
+    # the model's checkpoint key mapping on the way. Loading on "meta" and
+    # filling tensors by hand would only read every shard a second time.
     model = ModelClass.from_pretrained(
         input_path,
         torch_dtype=torch_dtype,
         device_map="cpu",
+        # Keep linear weights packed; the weight_scale buffers go on CompressedLinear
+        quantization_config=CompressedTensorsConfig(run_compressed=True),
         trust_remote_code=True,
     )
     if verbose:
@@ -56,7 +155,7 @@ def fix_nvfp4_model(input_path, output_path, dtype="bfloat16", verbose=True):
     
     # Find all safetensors shards
     if verbose:
-        print("\n2. Loading weight_scale tensors from safetensors...")
+        print("\n2. Locating weight_scale tensors in safetensors...")
     shard_files = sorted(glob.glob(str(input_path / "model-*.safetensors")))
     
     if not shard_files:
@@ -65,32 +164,52 @@ def fix_nvfp4_model(input_path, output_path, dtype="bfloat16", verbose=True):
     if verbose:
         print(f"Found {len(shard_files)} shard(s)")
     
-    scale_tensors = {}
-    for shard_path in shard_files:
-        with safe_open(shard_path, framework="pt") as f:
-            for key in f.keys():
-                if key.endswith('.weight_scale'):
-                    # Handle different naming conventions
-                    model_key = key.replace('language_model.model.layers', 'model.language_model.layers')
-                    module_name = model_key.replace('.weight_scale', '')
-                    
-                    # Convert float8 to target dtype
-                    scale = f.get_tensor(key)
-                    if scale.dtype == torch.float8_e4m3fn:
-                        scale = scale.to(torch_dtype)
-                    scale_tensors[module_name] = scale
+    # safetensors releases the GIL while reading, so shards can load in parallel
+    max_workers = max(1, min(8, len(shard_files)))
+    to_model_key = make_key_mapper(model)
+    scale_locations = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        shard_keys_iter = executor.map(lambda p: find_shard_scales(p, to_model_key), shard_files)
+        for shard_path, shard_keys in zip(shard_files, shard_keys_iter):
+            for module_name, key in shard_keys.items():
+                # Some converters write the same scale to several shards; keep the first
+                if module_name not in scale_locations:
+                    scale_locations[module_name] = (shard_path, key)
     
     if verbose:
-        print(f"✓ Found {len(scale_tensors)} weight_scale tensors")
+        print(f"✓ Found {len(scale_locations)} weight_scale tensors")
     
     # Inject scales
     if verbose:
         print("\n3. Injecting weight_scale buffers...")
-    injected = 0
-    for name, module in model.named_modules():
-        if hasattr(module, 'weight_packed') and name in scale_tensors:
-            module.register_buffer('weight_scale', scale_tensors[name])
-            injected += 1
+    targets = [
+        (name, module) for name, module in model.named_modules()
+        if hasattr(module, 'weight_packed') and name in scale_locations
+    ]
+    
+    # Validate once up front so the loop can write _buffers directly
+    # instead of paying register_buffer's checks per module
+    for name, module in targets:
+        if hasattr(module, 'weight_scale'):
+            raise KeyError(f"attribute 'weight_scale' already exists on {name}")
+    
+    # Read only the scales that will be injected, opening each shard once
+    scale_keys_by_shard = {}
+    for name, _ in targets:
+        shard_path, key = scale_locations[name]
+        scale_keys_by_shard.setdefault(shard_path, {})[name] = key
+    
+    target_modules = dict(targets)
+    sample_module = None
+    with torch.no_grad(), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for shard_scales in executor.map(
+            lambda item: load_shard_scales(item[0], item[1], torch_dtype),
+            scale_keys_by_shard.items(),
+        ):
+            for name, scale in shard_scales.items():
+                target_modules[name]._buffers['weight_scale'] = scale
+                sample_module = target_modules[name]
+    injected = len(targets)
     
     if verbose:
         print(f"✓ Injected {injected} buffers")
@@ -98,30 +217,52 @@ def fix_nvfp4_model(input_path, output_path, dtype="bfloat16", verbose=True):
     # Test
     if verbose:
         print("\n4. Testing forward pass...")
-    input_ids = torch.randint(0, 1000, (1, 10))
+    
+    # torch sizes its pool from the host's core count, which can exceed the
+    # CPUs this process is pinned to (cpusets / taskset). CPU quotas such as
+    # docker --cpus are not reflected here.
+    num_threads = torch.get_num_threads()
+    try:
+        available_cpus = len(os.sched_getaffinity(0))
+        if available_cpus < num_threads:
+            torch.set_num_threads(available_cpus)
+    except AttributeError:
+        pass  # sched_getaffinity is unavailable on macOS and Windows
+    
     try:
         with torch.no_grad():
-            _ = model(input_ids=input_ids)
+            if full_check or sample_module is None:
+                input_ids = torch.randint(0, 1000, (1, 10))
+                _ = model(input_ids=input_ids)
+            else:
+                # One patched layer is enough to exercise the weight_scale plumbing.
+                # Decompress directly: CompressedLinear.forward would register a
+                # dense weight on the module, which save_pretrained would then write.
+                weight = sample_module.compressor.decompress_module(sample_module)
+                x = torch.zeros(1, sample_module.in_features, dtype=weight.dtype)
+                _ = torch.nn.functional.linear(x, weight, sample_module.bias)
+                del weight
         if verbose:
             print("✓ Forward pass successful!")
     except Exception as e:
         if verbose:
             print(f"❌ Forward pass failed: {e}")
         raise
+    finally:
+        torch.set_num_threads(num_threads)
     
     # Save
     if verbose:
         print(f"\n5. Saving fixed model to {output_path}...")
-    output_path.mkdir(parents=True, exist_ok=True)
-    model.save_pretrained(output_path)
-    
-    # Copy tokenizer and config files
-    import shutil
-    for file in ["tokenizer.json", "tokenizer_config.json", "special_tokens_map.json", 
-                 "tokenizer.model", "vocab.json", "merges.txt"]:
-        src = input_path / file
-        if src.exists():
-            shutil.copy(src, output_path / file)
+    # Copy tokenizer and other side files first so save_pretrained's
+    # config.json and weights take precedence
+    shutil.copytree(
+        input_path,
+        output_path,
+        dirs_exist_ok=True,
+        ignore=side_file_filter(output_path),
+    )
+    model.save_pretrained(output_path, safe_serialization=True, max_shard_size="5GB")
     
     if verbose:
         print("✓ Done!")
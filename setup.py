@@ -29,7 +29,7 @@ setup(
     python_requires=">=3.8",
     install_requires=[
         "compressed-tensors>=0.13.0",
-        "transformers>=4.40.0",
+        "transformers>=4.48.0",
         "safetensors>=0.4.0",
         "torch>=2.0.0",
     ],